@@ -94,8 +94,11 @@ if [ "${MODELS_IN_CONTAINER}" != "true" ]; then
   MODEL_MOUNT_OPTS="-v ${MODELS_DIR}:/models:ro"
 fi
 
+# Shared memory for Real-CUGAN frame transfers (Docker's default /dev/shm is only 64 MB)
+: "${SHM_SIZE:=2g}"
+
 # Final docker run prefix (exports all toggles and paths)
-export DOCKER_RUN="docker run --rm --gpus all \
+export DOCKER_RUN="docker run --rm --gpus all --shm-size=${SHM_SIZE} \
   -v $PWD/logs:/tmp \
   -v $PWD:$PWD -w $PWD \
   ${MODEL_MOUNT_OPTS} ${EXTRA_MOUNTS} \
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Real-CUGAN persistent worker
+Loads the Real-CUGAN model once and upscales batches of planar RGB frames handed over
+by the VapourSynth wrapper (vsrealcugan.py) through shared memory
+
+Protocol (native byte order):
+    request:  header (frames, channels, height, width) as 4x uint32 followed by the
+              NUL-padded name of the output block on stdin; the NCHW uint8 batch
+              is in the --shm-in block
+    response: header (frames, channels, height, width) of the upscaled batch on
+              stdout, whose data has been written to the named output block; a
+              zero header signals failure
+
+Shared memory blocks are page-locked with cudaHostRegister, so batches are copied
+between them and the GPU by DMA without staging buffers.
+"""
+
+import os
+import sys
+import math
+import struct
+import argparse
+import collections
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+# upcunet_v3.py lives next to this script in /usr/local/lib/realcugan
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import torch
+import upcunet_v3
+
+FRAME_HEADER = struct.Struct("IIII")
+REQUEST_HEADER = struct.Struct("IIII64s")
+
+# Output blocks stay attached (and registered) while recently used and not unlinked
+MAX_OUTPUT_BLOCKS = 8
+SHM_DIR = "/dev/shm"
+
+
+def read_into(stream, buffer) -> bool:
+    """Fill a writable buffer from stream, or return False on EOF"""
+    view = memoryview(buffer).cast("B")
+    while view:
+        count = stream.readinto(view)
+        if not count:
+            return False
+        view = view[count:]
+    return True
+
+
+def attach_shm(name: str) -> SharedMemory:
+    """Attach to a shared memory block owned (and unlinked) by the wrapper"""
+    try:
+        return SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        shm = SharedMemory(name=name)
+        # Older Pythons track attached blocks too and would unlink them at exit
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class HostBlock:
+    """Shared memory block mapped as a uint8 tensor, page-locked on CUDA for direct DMA"""
+
+    def __init__(self, name: str, pin: bool):
+        self.shm = attach_shm(name)
+        self.data = torch.frombuffer(self.shm.buf, dtype=torch.uint8)
+        self.pinned = False
+        if pin:
+            err = torch.cuda.cudart().cudaHostRegister(self.data.data_ptr(), self.data.numel(), 0)
+            self.pinned = int(err) == 0
+            if not self.pinned:
+                print(f"[Real-CUGAN worker] cudaHostRegister failed ({err}), using pageable copies",
+                      file=sys.stderr)
+
+    def view(self, shape: tuple) -> torch.Tensor:
+        """Tensor of the given shape over the start of the block"""
+        count = math.prod(shape)
+        if count > self.data.numel():
+            raise ValueError(f"batch of {count} bytes exceeds shared memory")
+        return self.data[:count].view(shape)
+
+    def close(self):
+        if self.pinned:
+            torch.cuda.cudart().cudaHostUnregister(self.data.data_ptr())
+        self.data = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # A tensor view is still alive; the mapping goes away with it
+            pass
+
+
+class Upscaler:
+    """Real-CUGAN model kept resident on the GPU"""
+
+    def __init__(self, model_path: str, scale: int, tile: int, device_id: int, tta_mode: int,
+                 half: bool = False, cuda_graph: bool = False):
+        if device_id >= 0 and torch.cuda.is_available():
+            self.device = torch.device(f"cuda:{device_id}")
+        else:
+            self.device = torch.device("cpu")
+
+        self.tile = tile
+        self.tta_mode = tta_mode
+        # FP16 halves memory traffic and runs on Tensor Cores; CPU stays FP32
+        self.dtype = torch.half if half and self.device.type == "cuda" else torch.float
+
+        weight = torch.load(model_path, map_location="cpu")
+        self.model = getattr(upcunet_v3, f"UpCunet{scale}x")()
+        self.model.load_state_dict(weight, strict=True)
+        self.model = self.model.to(self.device, self.dtype).eval()
+
+        # Captured forward passes keyed by input shape: (graph, static input, static output)
+        self.cuda_graph = cuda_graph and self.device.type == "cuda"
+        self.graphs = {}
+
+    def _tile_mode(self, height: int, width: int) -> int:
+        """Map the tile size in pixels to the model's internal tile mode (0-4)"""
+        if self.tile <= 0:
+            return 0
+        splits = math.ceil(max(height, width) / self.tile)
+        return 0 if splits <= 1 else min(4, splits)
+
+    def _forward(self, x: torch.Tensor, tile_mode: int) -> torch.Tensor:
+        if not self.tta_mode:
+            return self.model(x, tile_mode)
+
+        # Flip-based test-time augmentation
+        result = None
+        for dims in ((), (3,), (2,), (2, 3)):
+            xi = torch.flip(x, dims) if dims else x
+            yi = self.model(xi, tile_mode)
+            yi = torch.flip(yi, dims) if dims else yi
+            result = yi if result is None else result + yi
+        return result / 4
+
+    def _graph_forward(self, x: torch.Tensor, tile_mode: int) -> torch.Tensor:
+        """Replay the forward pass as a CUDA graph, capturing it on first use of a shape"""
+        key = tuple(x.shape)
+        if key not in self.graphs:
+            static_in = x.clone()
+
+            # Warm up on a side stream so lazy initialisation is not captured
+            stream = torch.cuda.Stream(self.device)
+            stream.wait_stream(torch.cuda.current_stream(self.device))
+            with torch.cuda.stream(stream):
+                for _ in range(2):
+                    self._forward(static_in, tile_mode)
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                static_out = self._forward(static_in, tile_mode)
+            self.graphs[key] = (graph, static_in, static_out)
+
+        graph, static_in, static_out = self.graphs[key]
+        static_in.copy_(x)
+        graph.replay()
+        return static_out
+
+    def __call__(self, frames: torch.Tensor, output: HostBlock) -> tuple:
+        """Upscale an NCHW uint8 RGB batch into output in a single forward pass, returning its shape"""
+        with torch.no_grad():
+            x = frames.to(self.device, non_blocking=True).to(self.dtype) / 255
+            tile_mode = self._tile_mode(frames.shape[2], frames.shape[3])
+            if self.cuda_graph:
+                try:
+                    y = self._graph_forward(x, tile_mode)
+                except Exception as e:
+                    print(f"[Real-CUGAN worker] CUDA graph capture failed, disabling: {e}", file=sys.stderr)
+                    self.cuda_graph = False
+                    self.graphs.clear()
+                    y = self._forward(x, tile_mode)
+            else:
+                y = self._forward(x, tile_mode)
+            y = (y.float() * 255).round_().clamp_(0, 255).byte()
+
+            output.view(tuple(y.shape)).copy_(y, non_blocking=True)
+            if self.device.type == "cuda":
+                torch.cuda.current_stream(self.device).synchronize()
+        return tuple(y.shape)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Real-CUGAN persistent worker")
+    parser.add_argument("-m", "--model", required=True, help="Path to Real-CUGAN model weights")
+    parser.add_argument("-s", "--scale", type=int, default=4, help="Upscaling factor (2, 3 or 4)")
+    parser.add_argument("-t", "--tile", type=int, default=256, help="Tile size in pixels (0 disables tiling)")
+    parser.add_argument("-g", "--gpu", type=int, default=0, help="GPU device ID (-1 for CPU)")
+    parser.add_argument("-x", "--tta", action="store_true", help="Enable test-time augmentation")
+    parser.add_argument("--half", action="store_true", help="Run inference in FP16")
+    parser.add_argument("--cuda-graph", action="store_true", help="Replay the forward pass as a CUDA graph")
+    parser.add_argument("--shm-in", required=True, help="Shared memory block holding input batches")
+    args = parser.parse_args()
+
+    # stdout carries batch headers only; send any stray prints to stderr
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+    sys.stdout = sys.stderr
+
+    upscaler = Upscaler(args.model, args.scale, args.tile, args.gpu, int(args.tta), args.half,
+                        args.cuda_graph)
+
+    pin = upscaler.device.type == "cuda"
+    inputs = HostBlock(args.shm_in, pin)
+    # Output blocks are allocated by the wrapper and named per batch, least recently used first
+    outputs = collections.OrderedDict()
+
+    header = bytearray(REQUEST_HEADER.size)
+    while read_into(stdin, header):
+        *shape, name = REQUEST_HEADER.unpack(header)
+
+        try:
+            name = name.rstrip(b"\0").decode()
+            # Blocks the wrapper freed still hold their pages in /dev/shm while mapped here
+            for stale in [n for n in outputs if not os.path.exists(os.path.join(SHM_DIR, n))]:
+                outputs.pop(stale).close()
+            output = outputs.pop(name, None) or HostBlock(name, pin)
+            outputs[name] = output
+            while len(outputs) > MAX_OUTPUT_BLOCKS:
+                outputs.popitem(last=False)[1].close()
+
+            out_shape = upscaler(inputs.view(tuple(shape)), output)
+        except Exception as e:
+            print(f"[Real-CUGAN worker] Batch failed: {e}", file=sys.stderr)
+            stdout.write(FRAME_HEADER.pack(0, 0, 0, 0))
+            stdout.flush()
+            continue
+
+        stdout.write(FRAME_HEADER.pack(*out_shape))
+        stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -6,20 +6,137 @@ Optimized for animation content like Futurama
 
 import os
 import sys
-import tempfile
+import queue
+import select
+import collections
+import logging
+import functools
+import itertools
+import shutil
+import struct
+import threading
 import subprocess
+import weakref
 import numpy as np
 import vapoursynth as vs
+from multiprocessing.shared_memory import SharedMemory
 from PIL import Image
-from typing import Optional
+from typing import Callable, Optional
+
+# OpenCV's SIMD Lanczos is preferred for the fallback resize when available
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+# Used to read the input tensor name of ONNX exports for trtexec
+try:
+    import onnx
+except ImportError:
+    onnx = None
 
 core = vs.core
 
+# Library logging is silent unless the application configures the "realcugan" logger
+logger = logging.getLogger("realcugan")
+logger.addHandler(logging.NullHandler())
+
+# Repeated per-frame errors are only logged on the first and every Nth occurrence
+ERROR_LOG_INTERVAL = 100
+
+# Persistent worker installed next to upcunet_v3.py (see realcugan_worker.py)
+WORKER_SCRIPT = "/usr/local/lib/realcugan/realcugan_worker.py"
+
+# Seconds to wait for a worker's reply before it is considered hung and killed
+WORKER_TIMEOUT = 300
+
+# Consecutive worker start-up failures after which only the fallback is used
+MAX_WORKER_START_FAILURES = 3
+
+# TensorRT engine builder, used when vs-mlrt's core.trt and an ONNX export are available
+TRTEXEC = shutil.which("trtexec") or "/usr/src/tensorrt/bin/trtexec"
+
+# Built engines are cached here, the models directory is usually mounted read-only
+ENGINE_CACHE_DIR = os.environ.get("REALCUGAN_ENGINE_DIR",
+                                  os.path.join(os.path.expanduser("~"), ".cache", "realcugan"))
+
+# Upscaled batches kept for frames not fetched yet; older idle ones are dropped, so
+# frames that are skipped (seeks, trims) do not pin their batch forever
+MAX_PENDING_BATCHES = 8
+
+# Worker output pool: free arrays kept per shape, for this many shapes at most
+MAX_POOLED_SHAPES = 4
+
+# Batch headers exchanged with the worker over its pipes: frames, channels, height, width,
+# and for requests the name of the shared memory block receiving the upscaled batch.
+# The pixel data itself goes through shared memory.
+FRAME_HEADER = struct.Struct("IIII")
+REQUEST_HEADER = struct.Struct("IIII64s")
+
+
+# Shared memory is backed by this tmpfs. Docker gives containers 64 MB by default.
+SHM_DIR = "/dev/shm"
+
+
+def _create_shm(size: int) -> SharedMemory:
+    """Create a shared memory block, refusing when SHM_DIR cannot back all of its pages"""
+    # An oversized block is created fine but its first write past the free space is a
+    # SIGBUS that kills the process, so check up front
+    try:
+        stat = os.statvfs(SHM_DIR)
+    except OSError:
+        pass
+    else:
+        free = stat.f_bavail * stat.f_frsize
+        if free < size:
+            raise MemoryError(f"{SHM_DIR} has {free >> 20} MB free, {size >> 20} MB needed "
+                              f"(raise the container's --shm-size)")
+    return SharedMemory(create=True, size=size)
+
+
+class _SharedArray(np.ndarray):
+    """uint8 array backed by a shared memory block, so a worker can write into it by name"""
+    shm = None
+
+
+def _shared_array(shape: tuple) -> _SharedArray:
+    """Allocate a uint8 array in a new shared memory block, unlinked once the array is collected"""
+    shm = _create_shm(max(1, int(np.prod(shape))))
+    array = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf).view(_SharedArray)
+    array.shm = shm
+    weakref.finalize(array, shm.unlink)
+    return array
+
+
+def _tile_iter(arr: np.ndarray, tile: int, pad: int):
+    """
+    Split a CHW array into tile-sized regions
+
+    Yields (y, x, h, w, crop_y, crop_x, crop) where (y, x, h, w) is the region
+    and crop extends it by up to pad pixels of context on every side. Crops are
+    shifted inward at the frame edges so they all share one size and can be
+    batched together.
+    """
+    _, height, width = arr.shape
+    crop_h = min(height, tile + 2 * pad)
+    crop_w = min(width, tile + 2 * pad)
+
+    for y in range(0, height, tile):
+        h = min(tile, height - y)
+        crop_y = min(max(y - pad, 0), height - crop_h)
+        for x in range(0, width, tile):
+            w = min(tile, width - x)
+            crop_x = min(max(x - pad, 0), width - crop_w)
+            yield y, x, h, w, crop_y, crop_x, arr[:, crop_y:crop_y + crop_h, crop_x:crop_x + crop_w]
+
+
 class RealCUGAN:
     """Real-CUGAN upscaler for VapourSynth"""
 
     def __init__(self, device_id: int = 0, model_path: str = "", scale: int = 4,
-                 tile: int = 256, sync: int = 0, tta_mode: int = 0):
+                 tile: int = 256, sync: int = 0, tta_mode: int = 0, batch: int = 4,
+                 num_streams: int = 2, tile_pad: Optional[int] = None,
+                 precision: str = "fp16", calib_cache: str = "", use_cuda_graph: bool = False):
         """
         Initialize Real-CUGAN upscaler
 
@@ -30,12 +147,27 @@ class RealCUGAN:
             tile: Tile size for processing
             sync: Sync mode (not used in this implementation)
             tta_mode: Test-time augmentation mode
+            batch: Number of consecutive frames upscaled per inference call
+            num_streams: Number of worker processes kept busy in parallel
+            tile_pad: Overlap around each tile in pixels (default 10% of tile)
+            precision: Inference precision (fp32, fp16 or int8; int8 needs TensorRT)
+            calib_cache: TensorRT INT8 calibration cache path
+            use_cuda_graph: Replay inference as a CUDA graph (fixed tile shapes make this cheap)
         """
+        if precision not in ("fp32", "fp16", "int8"):
+            raise ValueError(f"Unsupported Real-CUGAN precision: {precision}")
+
         self.device_id = device_id
         self.model_path = model_path
         self.scale = scale
         self.tile = tile
+        self.tile_pad = tile // 10 if tile_pad is None else max(0, tile_pad)
         self.tta_mode = tta_mode
+        self.batch = max(1, batch)
+        self.num_streams = max(1, num_streams)
+        self.precision = precision
+        self.calib_cache = calib_cache
+        self.use_cuda_graph = use_cuda_graph
 
         # Determine model name and scale from path
         if "up2x" in model_path or "2x" in model_path:
@@ -51,215 +183,650 @@ class RealCUGAN:
         else:
             self.noise = -1  # No denoising
 
-        print(f"[Real-CUGAN] Initialized with scale={self.scale}, noise={self.noise}, tile={self.tile}")
+        # Resolve the backend once instead of attempting the import per frame
+        try:
+            import realcugan
+            # Try to use Real-CUGAN Python API if available
+            self._backend = self._process_with_python_api
+        except ImportError:
+            # Fallback to command line tool
+            self._backend = self._process_with_cli
+
+        # A TensorRT engine replaces the worker when vs-mlrt and an ONNX export exist
+        # (TTA is only implemented by the worker)
+        self._onnx_path = os.path.splitext(model_path)[0] + ".onnx"
+        self._use_trt = not tta_mode and hasattr(core, "trt") and os.path.isfile(self._onnx_path)
+
+        if precision == "int8" and not self._use_trt:
+            logger.warning("INT8 requires TensorRT, using fp16")
+            self.precision = "fp16"
+
+        # Worker command line is fixed for the lifetime of the upscaler
+        self._worker_cmd = [
+            "python3", WORKER_SCRIPT,
+            "-m", self.model_path,
+            "-s", str(self.scale),
+            "-t", "0",  # Tiling is done here, see _process_image_array
+            "-g", str(self.device_id)
+        ]
+
+        if self.tta_mode:
+            self._worker_cmd.extend(["-x"])
+
+        # INT8 only exists for TensorRT; if the engine cannot be used the worker runs FP16
+        if self.precision in ("fp16", "int8"):
+            self._worker_cmd.extend(["--half"])
+
+        if self.use_cuda_graph:
+            self._worker_cmd.extend(["--cuda-graph"])
+
+        # Worker processes are started on first use. Each VapourSynth thread borrows a
+        # free worker, so up to num_streams batches are in flight at once and the
+        # transfer of one overlaps with GPU compute of another.
+        self._workers = [None] * self.num_streams
+        # Input shared memory of each worker, sized on first use. Workers write their
+        # output into the pooled batch buffer named in each request, see _get_out_buf.
+        self._shm = [None] * self.num_streams
+        self._free_workers = queue.Queue()
+        for index in range(self.num_streams):
+            self._free_workers.put(index)
+        # Stop the workers when the upscaler is collected (e.g. evicted from
+        # _get_upscaler's cache with no clip left using it) or at exit. The
+        # finalizer only holds the lists, not the upscaler itself.
+        self._finalizer = weakref.finalize(self, RealCUGAN._release_workers, self._workers, self._shm)
+
+        # Workers that keep dying at start-up (e.g. missing weights) are not respawned
+        # for every batch; frames go straight to the fallback instead
+        self._worker_start_failures = 0
+        self._worker_unavailable = False
+        if not os.path.isfile(self.model_path):
+            logger.warning("Real-CUGAN model not found: %s, using fallback upscaling", self.model_path)
+            self._worker_unavailable = True
+
+        # Per-thread conversion buffers
+        self._scratch = threading.local()
+
+        # Error counter for throttled logging from the frame callbacks
+        self._error_count = itertools.count(1)
+
+        # Upscaled batches keyed by (clip, first frame), least recently used first, until
+        # every frame is fetched. One upscaler may serve several clips, see real_cugan().
+        self._batches = collections.OrderedDict()
+        self._clip_ids = itertools.count()
+        self._batches_lock = threading.Lock()
+
+        # Recycled worker output arrays in shared memory by shape, least recently used
+        # first, so large blocks are not allocated (and attached by the worker) for every
+        # batch. Each stream can have a batch in flight and one waiting to be consumed.
+        self._out_pool = collections.OrderedDict()
+        self._out_pool_depth = 2 * self.num_streams
+        self._out_pool_lock = threading.Lock()
+
+        logger.info("Initialized with scale=%d, noise=%d, tile=%d, batch=%d, streams=%d, precision=%s",
+                    self.scale, self.noise, self.tile, self.batch, self.num_streams, self.precision)
 
     def __call__(self, clip: vs.VideoNode) -> vs.VideoNode:
         """Process VapourSynth clip with Real-CUGAN"""
 
-        def process_frame(n: int, f: vs.VideoFrame) -> vs.VideoFrame:
-            """Process individual frame"""
-            try:
-                # Convert VapourSynth frame to numpy array
-                img_array = self._vs_frame_to_array(f)
-
-                # Process with Real-CUGAN
-                upscaled_array = self._process_image_array(img_array)
+        if clip.format.color_family != vs.RGB or clip.format.bits_per_sample not in (8, 32):
+            raise ValueError(f"Real-CUGAN supports RGB24 and RGBS clips, got {clip.format.name}")
 
-                # Convert back to VapourSynth frame
-                return self._array_to_vs_frame(upscaled_array, f)
+        if self._use_trt:
+            try:
+                return self._trt_model(clip)
+            except Exception as e:
+                logger.warning("TensorRT unavailable, using the Real-CUGAN worker: %s", e)
+                self._use_trt = False
+                if self.precision == "int8":
+                    self.precision = "fp16"
+
+        clip_id = next(self._clip_ids)
+        batch = min(self.batch, clip.num_frames)
+
+        def process_frame(n: int, f: list) -> vs.VideoFrame:
+            """Process individual frame, upscaling its whole batch on first request"""
+            start = n - n % batch
+            # f[0] comes from the upscaled template and already has the output dimensions
+            new_frame = f[0].copy()
+            frames = f[1:]
+            try:
+                # Process with Real-CUGAN and convert back to VapourSynth frame
+                return self._process_batch((clip_id, start), n - start, min(batch, clip.num_frames - start), frames,
+                                           lambda upscaled: self._array_to_vs_frame(upscaled[n - start], new_frame))
 
             except Exception as e:
-                print(f"[Real-CUGAN] Error processing frame {n}: {e}")
+                self._log_error("Error processing frame %d: %s", n, e)
                 # Return original frame scaled with basic method as fallback
-                return self._fallback_upscale(f)
+                return self._fallback_upscale(frames[n - start], new_frame)
 
         # Create output clip with new dimensions
         new_width = clip.width * self.scale
         new_height = clip.height * self.scale
+        # keep=True renders the blank template frame once instead of per request
+        template = core.std.BlankClip(clip, width=new_width, height=new_height, keep=True)
+
+        # Frame n receives every frame of its batch: clip k yields frame start + k.
+        # The source is padded with its last frame so the final batch is full.
+        padded = clip
+        if clip.num_frames % batch:
+            padded = clip + clip[-1] * (batch - clip.num_frames % batch)
+        batch_clips = [
+            core.std.Interleave([core.std.SelectEvery(padded, batch, k)] * batch)[:clip.num_frames]
+            for k in range(batch)
+        ]
 
         # Process clip
-        return core.std.ModifyFrame(clip, clip, process_frame)
-
-    def _vs_frame_to_array(self, frame: vs.VideoFrame) -> np.ndarray:
-        """Convert VapourSynth frame to numpy array (RGB)"""
-        # Get frame planes
-        r_plane = np.array(frame.get_read_array(0), copy=False)
-        g_plane = np.array(frame.get_read_array(1), copy=False)
-        b_plane = np.array(frame.get_read_array(2), copy=False)
-
-        # Stack planes into RGB array
-        rgb_array = np.stack([r_plane, g_plane, b_plane], axis=-1)
-
-        # Convert from float to uint8 if needed
-        if rgb_array.dtype == np.float32:
-            rgb_array = (rgb_array * 255).astype(np.uint8)
-
-        return rgb_array
-
-    def _array_to_vs_frame(self, array: np.ndarray, original_frame: vs.VideoFrame) -> vs.VideoFrame:
-        """Convert numpy array back to VapourSynth frame"""
-        # Ensure array is uint8
-        if array.dtype != np.uint8:
-            array = (array * 255).astype(np.uint8)
-
-        # Create new frame with upscaled dimensions
-        new_height, new_width = array.shape[:2]
-
-        # Split RGB channels
-        r_plane = array[:, :, 0]
-        g_plane = array[:, :, 1]
-        b_plane = array[:, :, 2]
-
-        # Create new clip with proper dimensions
-        blank = core.std.BlankClip(
-            width=new_width,
-            height=new_height,
-            format=original_frame.format,
-            length=1
+        return core.std.ModifyFrame(template, [template] + batch_clips, process_frame)
+
+    def _log_error(self, msg: str, *args):
+        """Log a per-frame error, throttled so failure bursts do not flood the output"""
+        count = next(self._error_count)
+        if count == 1 or count % ERROR_LOG_INTERVAL == 0:
+            logger.warning(msg + " (%d errors so far)", *args, count)
+
+    def _trt_model(self, clip: vs.VideoNode) -> vs.VideoNode:
+        """Upscale with a TensorRT engine through vs-mlrt's core.trt filter"""
+        # Engines have a fixed input shape: one padded tile, or the whole frame.
+        # vs-mlrt's tilesize is the full network input with the overlap inside it.
+        if self._needs_tiling(clip.height, clip.width):
+            tilesize = [min(self.tile + 2 * self.tile_pad, clip.width),
+                        min(self.tile + 2 * self.tile_pad, clip.height)]
+            overlap = [self.tile_pad, self.tile_pad]
+        else:
+            tilesize = [clip.width, clip.height]
+            overlap = [0, 0]
+
+        engine_path = self._build_trt_engine(tilesize[0], tilesize[1])
+
+        rgbs = clip if clip.format.id == vs.RGBS else core.resize.Point(clip, format=vs.RGBS)
+        upscaled = core.trt.Model(
+            rgbs,
+            engine_path=engine_path,
+            tilesize=tilesize,
+            overlap=overlap,
+            device_id=self.device_id,
+            use_cuda_graph=self.use_cuda_graph,
+            num_streams=self.num_streams
         )
 
-        # Get frame and set data
-        new_frame = blank.get_frame(0)
+        if clip.format.id == vs.RGBS:
+            return upscaled
+        return core.resize.Point(upscaled, format=clip.format.id)
+
+    def _build_trt_engine(self, width: int, height: int) -> str:
+        """Build the TensorRT engine for one input shape once and cache it in ENGINE_CACHE_DIR"""
+        name = os.path.splitext(os.path.basename(self._onnx_path))[0]
+        engine_path = os.path.join(ENGINE_CACHE_DIR, f"{name}_{self.precision}_{width}x{height}.engine")
+        if os.path.isfile(engine_path):
+            return engine_path
+        os.makedirs(ENGINE_CACHE_DIR, exist_ok=True)
+
+        cmd = [
+            TRTEXEC,
+            f"--onnx={self._onnx_path}",
+            f"--shapes={self._onnx_input_name()}:1x3x{height}x{width}",
+            f"--saveEngine={engine_path}",
+            f"--device={self.device_id}"
+        ]
+
+        if self.precision == "fp16":
+            cmd.append("--fp16")
+        elif self.precision == "int8":
+            # Layers without INT8 kernels fall back to FP16
+            cmd.extend(["--int8", "--fp16"])
+            if self.calib_cache:
+                cmd.append(f"--calib={self.calib_cache}")
+            else:
+                logger.warning("No INT8 calibration cache given, engine will be uncalibrated")
+
+        logger.info("Building TensorRT engine: %s", engine_path)
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"trtexec failed: {result.stderr.strip()[-500:]}")
 
-        # Copy plane data
-        np.copyto(np.array(new_frame.get_write_array(0), copy=False), r_plane)
-        np.copyto(np.array(new_frame.get_write_array(1), copy=False), g_plane)
-        np.copyto(np.array(new_frame.get_write_array(2), copy=False), b_plane)
+        return engine_path
 
-        return new_frame
+    def _onnx_input_name(self) -> str:
+        """Name of the ONNX model's image input, "input" when it cannot be read"""
+        if onnx is None:
+            return "input"
 
-    def _process_image_array(self, img_array: np.ndarray) -> np.ndarray:
-        """Process image array with Real-CUGAN via subprocess"""
+        graph = onnx.load(self._onnx_path, load_external_data=False).graph
+        # Older exports also list the weights as graph inputs
+        weights = {init.name for init in graph.initializer}
+        names = [i.name for i in graph.input if i.name not in weights]
+        return names[0] if names else "input"
+
+    def _process_batch(self, key: tuple, index: int, count: int, frames: list,
+                       consume: Callable[[np.ndarray], vs.VideoFrame]):
+        """
+        Upscale the batch identified by (clip, first frame) once and share it between its frames
+
+        consume receives the upscaled batch for frame index of the batch and its return value
+        is passed through. Once all count frames have consumed the batch and no consumer still
+        reads it, its buffer goes back to the output pool. Repeated requests for a frame do not
+        count twice.
+        """
+        with self._batches_lock:
+            entry = self._batches.get(key)
+            if entry is None:
+                entry = self._batches[key] = {"lock": threading.Lock(), "result": None, "done": set(), "users": 0}
+            self._batches.move_to_end(key)
+            # Taken under the lock that recycles, so the buffer cannot be reused while read.
+            # Also keeps this batch out of the eviction below.
+            entry["users"] += 1
+            self._evict_batches()
 
-        # Use Real-CUGAN command line tool
         try:
-            import realcugan
-            # Try to use Real-CUGAN Python API if available
-            return self._process_with_python_api(img_array)
-        except ImportError:
-            # Fallback to command line tool
-            return self._process_with_cli(img_array)
+            with entry["lock"]:
+                if entry["result"] is None:
+                    entry["result"] = self._process_frames(frames)
+            return consume(entry["result"])
+        finally:
+            # Drop the batch once all of its frames have been handed out
+            with self._batches_lock:
+                entry["users"] -= 1
+                entry["done"].add(index)
+                if len(entry["done"]) >= count and self._batches.get(key) is entry:
+                    del self._batches[key]
+                if self._batches.get(key) is not entry:
+                    self._recycle_batch(entry)
+
+    def _evict_batches(self):
+        """Forget the least recently used idle batches beyond MAX_PENDING_BATCHES, caller holds _batches_lock"""
+        idle = [key for key, entry in self._batches.items() if not entry["users"]]
+        for key in idle[:max(0, len(self._batches) - MAX_PENDING_BATCHES)]:
+            self._recycle_batch(self._batches.pop(key))
+
+    def _recycle_batch(self, entry: dict):
+        """Return the buffer of a batch dropped from _batches once its last reader is done"""
+        if not entry["users"] and entry["result"] is not None:
+            result, entry["result"] = entry["result"], None
+            self._put_out_buf(result)
+
+    def _get_out_buf(self, shape: tuple) -> np.ndarray:
+        """Take a recycled worker output array of this shape from the pool, or allocate one in shared memory"""
+        with self._out_pool_lock:
+            free = self._out_pool.get(shape)
+            if free:
+                self._out_pool.move_to_end(shape)
+                return free.pop()
+        return _shared_array(shape)
+
+    def _put_out_buf(self, buf: np.ndarray):
+        """Return an array nothing references anymore to the pool, dropping it when its shape is full"""
+        # Only worker output buffers are pooled, others were plain np.empty arrays
+        if not isinstance(buf, _SharedArray):
+            return
+        with self._out_pool_lock:
+            free = self._out_pool.setdefault(buf.shape, [])
+            self._out_pool.move_to_end(buf.shape)
+            if len(free) < self._out_pool_depth:
+                free.append(buf)
+            while len(self._out_pool) > MAX_POOLED_SHAPES:
+                self._out_pool.popitem(last=False)
+
+    def _process_frames(self, frames: list) -> np.ndarray:
+        """Upscale a list of VapourSynth frames as one NCHW batch"""
+        if self._backend == self._process_with_cli and not self._needs_tiling(frames[0].height, frames[0].width):
+            # Planes are converted straight into the worker's shared memory, without a staging array
+            return self._process_with_cli(frames)
+
+        return self._process_image_array(self._batch_to_array(frames))
+
+    @staticmethod
+    def _batch_shape(batch) -> tuple:
+        """NCHW shape of a batch given as an array or a list of CHW arrays or VapourSynth frames"""
+        first = batch[0]
+        if isinstance(first, vs.VideoFrame):
+            return (len(batch), 3, first.height, first.width)
+        return (len(batch),) + first.shape
+
+    def _write_batch(self, out: np.ndarray, batch):
+        """Copy a batch (array, or list of CHW arrays or VapourSynth frames) into an NCHW uint8 array"""
+        for item, img_array in zip(batch, out):
+            if isinstance(item, vs.VideoFrame):
+                self._vs_frame_to_array(item, img_array)
+            else:
+                np.copyto(img_array, item)
+        return out
+
+    def _batch_to_array(self, batch) -> np.ndarray:
+        """Copy a batch into a new NCHW uint8 array"""
+        return self._write_batch(np.empty(self._batch_shape(batch), dtype=np.uint8), batch)
+
+    def _vs_frame_to_array(self, frame: vs.VideoFrame, out: np.ndarray) -> np.ndarray:
+        """Copy VapourSynth frame planes into a planar CHW uint8 array"""
+        # Read the sample type from the frame, an upscaler can serve clips of both formats
+        float_format = frame.format.sample_type == vs.FLOAT
+        # RGB24 planes are copied as raw bytes into the (contiguous) destination,
+        # without building an ndarray wrapper per plane
+        dest = None if float_format or not out.flags.c_contiguous else memoryview(out).cast("B")
+        plane_size = frame.width * frame.height
+        for i in range(3):
+            plane = frame.get_read_array(i)
+
+            # Convert from float to uint8 if needed
+            if float_format:
+                self._float_to_u8(np.asarray(plane), out[i])
+                continue
+
+            view = memoryview(plane)
+            # Planes are only contiguous when the frame stride equals its width
+            if dest is not None and view.c_contiguous:
+                dest[i * plane_size:(i + 1) * plane_size] = view.cast("B")
+            else:
+                np.copyto(out[i], view)
+
+        return out
+
+    def _float_to_u8(self, plane: np.ndarray, out: np.ndarray):
+        """Saturating round of a 0-1 float plane to uint8 via a reused scratch buffer"""
+        # VapourSynth calls frames from several threads, so each keeps its own scratch
+        scratch = getattr(self._scratch, "f32", None)
+        if scratch is None or scratch.shape != plane.shape:
+            scratch = self._scratch.f32 = np.empty(plane.shape, dtype=np.float32)
+
+        np.multiply(plane, np.float32(255), out=scratch)
+        np.clip(scratch, 0, 255, out=scratch)
+        np.add(scratch, np.float32(0.5), out=out, casting="unsafe")
+
+    def _array_to_vs_frame(self, array: np.ndarray, new_frame: vs.VideoFrame) -> vs.VideoFrame:
+        """Copy planar CHW uint8 array into a writable VapourSynth frame of the upscaled size"""
+        float_format = new_frame.format.sample_type == vs.FLOAT
+        for i in range(3):
+            plane = np.asarray(new_frame.get_write_array(i))
+
+            if float_format:
+                np.multiply(array[i], np.float32(1 / 255), out=plane)
+            else:
+                np.copyto(plane, array[i])
+
+        return new_frame
 
-    def _process_with_python_api(self, img_array: np.ndarray) -> np.ndarray:
+    def _needs_tiling(self, height: int, width: int) -> bool:
+        """Whether frames of this size are split into tiles before inference"""
+        return self.tile > 0 and (height > self.tile or width > self.tile)
+
+    def _process_image_array(self, img_array: np.ndarray) -> np.ndarray:
+        """Process an NCHW batch with the Real-CUGAN backend, tile by tile for large frames"""
+        frames, channels, height, width = img_array.shape
+        if not self._needs_tiling(height, width):
+            return self._backend(img_array)
+
+        # Overlapping crops of every frame, submitted batch by batch to bound VRAM.
+        # Crops stay views and are only copied into the worker's input buffer.
+        tiles = [(i, region) for i, frame in enumerate(img_array)
+                 for region in _tile_iter(frame, self.tile, self.tile_pad)]
+        crops = [region[-1] for _, region in tiles]
+
+        s = self.scale
+        output = np.empty((frames, channels, height * s, width * s), dtype=np.uint8)
+
+        def stitch(upscaled: np.ndarray, chunk: list):
+            """Copy the tile centres into the output, dropping the padded context"""
+            for (i, (y, x, h, w, crop_y, crop_x, _)), tile_out in zip(chunk, upscaled):
+                top, left = (y - crop_y) * s, (x - crop_x) * s
+                output[i, :, y * s:(y + h) * s, x * s:(x + w) * s] = tile_out[:, top:top + h * s, left:left + w * s]
+
+        for first in range(0, len(tiles), self.batch):
+            chunk = tiles[first:first + self.batch]
+            # Stitch straight from the worker's output buffer, without an intermediate copy
+            self._backend(crops[first:first + self.batch], lambda upscaled: stitch(upscaled, chunk))
+
+        return output
+
+    def _process_with_python_api(self, img_array: np.ndarray,
+                                 sink: Optional[Callable[[np.ndarray], None]] = None) -> Optional[np.ndarray]:
         """Process using Real-CUGAN Python API"""
         try:
             import torch
-            from PIL import Image
-
-            # Convert to PIL Image
-            pil_img = Image.fromarray(img_array, 'RGB')
 
             # Use Real-CUGAN model (this would need the actual Real-CUGAN implementation)
             # For now, we'll use a placeholder that calls the CLI
-            return self._process_with_cli(img_array)
+            return self._process_with_cli(img_array, sink)
 
         except Exception as e:
-            print(f"[Real-CUGAN] Python API failed: {e}")
-            return self._process_with_cli(img_array)
-
-    def _process_with_cli(self, img_array: np.ndarray) -> np.ndarray:
-        """Process using Real-CUGAN command line tool"""
+            self._log_error("Python API failed: %s", e)
+            return self._process_with_cli(img_array, sink)
+
+    def _ensure_worker(self, index: int, in_size: int) -> tuple:
+        """Start persistent Real-CUGAN worker index with input shared memory of at least in_size"""
+        worker, shm = self._workers[index], self._shm[index]
+        if shm is not None and shm.size < in_size:
+            # Larger frames than before, restart with a bigger buffer
+            self._stop_worker(index)
+            worker = shm = None
+
+        if worker is not None and worker.poll() is None:
+            return worker, shm
+
+        if shm is None:
+            shm = self._shm[index] = _create_shm(in_size)
+
+        cmd = self._worker_cmd + ["--shm-in", shm.name]
+        # Unbuffered pipes, so select() on stdout sees every pending reply byte
+        worker = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+        self._workers[index] = worker
+        return worker, shm
+
+    def _stop_worker(self, index: int):
+        """Terminate persistent worker index and release its shared memory"""
+        self._release_worker(self._workers, self._shm, index)
+
+    @staticmethod
+    def _release_worker(workers: list, shms: list, index: int):
+        """Terminate worker index of the given lists and release its shared memory"""
+        worker, workers[index] = workers[index], None
+        shm, shms[index] = shms[index], None
+
+        if worker is not None:
+            try:
+                worker.stdin.close()
+                worker.wait(timeout=5)
+            except Exception:
+                worker.kill()
+                worker.wait()
 
-        with tempfile.TemporaryDirectory() as temp_dir:
-            input_path = os.path.join(temp_dir, "input.png")
-            output_path = os.path.join(temp_dir, "output.png")
+        if shm is not None:
+            try:
+                shm.close()
+            except BufferError:
+                # A view is still alive; the mapping goes away with it
+                pass
+            shm.unlink()
+
+    def _stop_workers(self):
+        """Terminate all persistent workers"""
+        self._release_workers(self._workers, self._shm)
+
+    @classmethod
+    def _release_workers(cls, workers: list, shms: list):
+        """Terminate every worker of the given lists, also run as the upscaler's finalizer"""
+        for index in range(len(workers)):
+            cls._release_worker(workers, shms, index)
+
+    @staticmethod
+    def _read_into(stream, buffer, timeout: Optional[float] = None):
+        """Fill a writable buffer directly from a worker pipe, waiting at most timeout seconds per read"""
+        view = memoryview(buffer).cast("B")
+        while view:
+            if timeout is not None and not select.select([stream], [], [], timeout)[0]:
+                raise TimeoutError(f"Real-CUGAN worker did not reply within {timeout}s")
+            count = stream.readinto(view)
+            if not count:
+                raise EOFError("Real-CUGAN worker exited unexpectedly")
+            view = view[count:]
+
+    def _process_with_cli(self, img_array,
+                          sink: Optional[Callable[[np.ndarray], None]] = None) -> Optional[np.ndarray]:
+        """
+        Process an NCHW batch (array, or list of CHW arrays or frames) using the persistent Real-CUGAN worker
 
-            # Save input image
-            pil_img = Image.fromarray(img_array, 'RGB')
-            pil_img.save(input_path)
+        The worker writes the upscaled batch straight into a pooled buffer, which is
+        returned, or with sink, handed to sink and recycled, returning None.
+        """
 
-            # Construct Real-CUGAN command
-            cmd = [
-                "python3", "/usr/local/lib/realcugan/upcunet_v3.py",
-                "-i", input_path,
-                "-o", output_path,
-                "-s", str(self.scale),
-                "-n", str(self.noise),
-                "-t", str(self.tile)
-            ]
+        shape = self._batch_shape(img_array)
+        out_shape = (shape[0], shape[1], shape[2] * self.scale, shape[3] * self.scale)
 
-            if self.tta_mode:
-                cmd.extend(["-x"])
+        output = None
+        if not self._worker_unavailable:
+            output = self._run_worker(img_array, shape, out_shape)
 
-            # Add GPU specification
-            if self.device_id >= 0:
-                cmd.extend(["-g", str(self.device_id)])
+        if output is None:
+            if not isinstance(img_array, np.ndarray):
+                img_array = self._batch_to_array(img_array)
+            output = self._fallback_upscale_batch(img_array)
 
-            try:
-                # Run Real-CUGAN
-                result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-
-                if result.returncode != 0:
-                    print(f"[Real-CUGAN] CLI failed: {result.stderr}")
-                    return self._fallback_upscale_array(img_array)
-
-                # Load output image
-                if os.path.exists(output_path):
-                    output_img = Image.open(output_path)
-                    return np.array(output_img)
-                else:
-                    print("[Real-CUGAN] Output file not created")
-                    return self._fallback_upscale_array(img_array)
-
-            except subprocess.TimeoutExpired:
-                print("[Real-CUGAN] Processing timeout")
-                return self._fallback_upscale_array(img_array)
-            except Exception as e:
-                print(f"[Real-CUGAN] CLI processing failed: {e}")
-                return self._fallback_upscale_array(img_array)
+        if sink is not None:
+            sink(output)
+            self._put_out_buf(output)
+            return None
+        return output
 
-    def _fallback_upscale_array(self, img_array: np.ndarray) -> np.ndarray:
-        """Fallback upscaling using PIL"""
-        pil_img = Image.fromarray(img_array, 'RGB')
-        new_size = (pil_img.width * self.scale, pil_img.height * self.scale)
-        upscaled_img = pil_img.resize(new_size, Image.LANCZOS)
-        return np.array(upscaled_img)
-
-    def _fallback_upscale(self, frame: vs.VideoFrame) -> vs.VideoFrame:
-        """Fallback upscaling for VapourSynth frame"""
-        # Convert to array, upscale, convert back
-        img_array = self._vs_frame_to_array(frame)
-        upscaled_array = self._fallback_upscale_array(img_array)
-        return self._array_to_vs_frame(upscaled_array, frame)
+    def _run_worker(self, img_array, shape: tuple, out_shape: tuple) -> Optional[np.ndarray]:
+        """Upscale a batch on a free worker into a pooled buffer, or return None if it failed"""
+        try:
+            result = self._get_out_buf(out_shape)
+        except MemoryError as e:
+            # Not enough shared memory for the output, not a worker problem
+            self._log_error("Cannot allocate worker output: %s", e)
+            return None
+
+        output = None
+        failed = False
+        index = self._free_workers.get()
+        worker = self._workers[index]
+        starting = worker is None or worker.poll() is not None
+        try:
+            worker, shm_in = self._ensure_worker(index, int(np.prod(shape)))
+
+            # Copy batch straight into the worker's input buffer; only the header is piped
+            self._write_batch(np.ndarray(shape, dtype=np.uint8, buffer=shm_in.buf), img_array)
+            worker.stdin.write(REQUEST_HEADER.pack(*shape, result.shm.name.encode()))
+            worker.stdin.flush()
+
+            # The reply header says the worker wrote the upscaled batch into result
+            header = bytearray(FRAME_HEADER.size)
+            self._read_into(worker.stdout, header, WORKER_TIMEOUT)
+            if FRAME_HEADER.unpack(header) == out_shape:
+                output = result
+                self._worker_start_failures = 0
+            else:
+                self._log_error("Worker failed to process batch")
+                self._put_out_buf(result)
 
+        except Exception as e:
+            self._log_error("CLI processing failed: %s", e)
+            output = None
+            failed = True
+            if starting:
+                self._worker_start_failures += 1
+                if self._worker_start_failures >= MAX_WORKER_START_FAILURES and not self._worker_unavailable:
+                    logger.warning("Real-CUGAN worker failed to start %d times, using fallback upscaling",
+                                   self._worker_start_failures)
+                    self._worker_unavailable = True
+        finally:
+            if failed:
+                # Worker state is unknown after a pipe error or timeout, restart on next frame
+                self._stop_worker(index)
+            self._free_workers.put(index)
+
+        return output
+
+    def _fallback_upscale_array(self, img_array: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """Fallback upscaling of a CHW array using OpenCV or PIL Lanczos"""
+        channels, height, width = img_array.shape
+        new_size = (width * self.scale, height * self.scale)
+        if out is None:
+            out = np.empty((channels, new_size[1], new_size[0]), dtype=np.uint8)
+
+        for plane, out_plane in zip(img_array, out):
+            if cv2 is not None:
+                cv2.resize(plane, new_size, dst=out_plane, interpolation=cv2.INTER_LANCZOS4)
+            else:
+                pil_img = Image.fromarray(plane, 'L')
+                np.copyto(out_plane, np.asarray(pil_img.resize(new_size, Image.LANCZOS)))
 
-def create_real_cugan_function():
-    """Create Real-CUGAN function for VapourSynth"""
+        return out
 
-    def real_cugan(clip: vs.VideoNode, model_path: str = "", scale: int = 4,
-                   tile: int = 256, device_id: int = 0, noise: int = -1,
-                   tta_mode: int = 0) -> vs.VideoNode:
-        """
-        Real-CUGAN upscaling function for VapourSynth
+    def _fallback_upscale_batch(self, img_arrays: np.ndarray) -> np.ndarray:
+        """Fallback upscaling for an NCHW batch"""
+        frames, channels, height, width = img_arrays.shape
+        out = np.empty((frames, channels, height * self.scale, width * self.scale), dtype=np.uint8)
+        for img_array, out_array in zip(img_arrays, out):
+            self._fallback_upscale_array(img_array, out_array)
+        return out
 
-        Args:
-            clip: Input video clip
-            model_path: Path to Real-CUGAN model
-            scale: Upscaling factor (2 or 4)
-            tile: Tile size for processing
-            device_id: GPU device ID
-            noise: Noise reduction level (-1, 0, 1, 2, 3)
-            tta_mode: Test-time augmentation
-        """
+    def _fallback_upscale(self, frame: vs.VideoFrame, new_frame: vs.VideoFrame) -> vs.VideoFrame:
+        """Fallback upscaling for VapourSynth frame"""
+        # Reuse this thread's buffers, the result is copied out immediately
+        shape = (3, frame.height, frame.width)
+        if getattr(self._scratch, "fallback_in", None) is None or self._scratch.fallback_in.shape != shape:
+            self._scratch.fallback_in = np.empty(shape, dtype=np.uint8)
+            self._scratch.fallback_out = np.empty((3, new_frame.height, new_frame.width), dtype=np.uint8)
 
-        if not model_path:
-            # Use default model based on scale
-            if scale == 2:
-                model_path = "/models/realcugan/Real-CUGAN_up2x-latest-denoise3x.pth"
-            else:
-                model_path = "/models/realcugan/Real-CUGAN_up4x-latest-conservative.pth"
-
-        upscaler = RealCUGAN(
-            device_id=device_id,
-            model_path=model_path,
-            scale=scale,
-            tile=tile,
-            tta_mode=tta_mode
-        )
+        # Convert to array, upscale, convert back
+        img_array = self._vs_frame_to_array(frame, self._scratch.fallback_in)
+        upscaled_array = self._fallback_upscale_array(img_array, self._scratch.fallback_out)
+        return self._array_to_vs_frame(upscaled_array, new_frame)
+
+@functools.lru_cache(maxsize=4)
+def _get_upscaler(model_path: str, scale: int, tile: int, device_id: int, tta_mode: int,
+                  batch: int, num_streams: int, tile_pad: Optional[int], precision: str,
+                  calib_cache: str, use_cuda_graph: bool) -> RealCUGAN:
+    """Return a cached upscaler, so repeated calls reuse its loaded model and workers"""
+    return RealCUGAN(
+        device_id=device_id,
+        model_path=model_path,
+        scale=scale,
+        tile=tile,
+        tta_mode=tta_mode,
+        batch=batch,
+        num_streams=num_streams,
+        tile_pad=tile_pad,
+        precision=precision,
+        calib_cache=calib_cache,
+        use_cuda_graph=use_cuda_graph
+    )
+
+
+def real_cugan(clip: vs.VideoNode, model_path: str = "", scale: int = 4,
+               tile: int = 256, device_id: int = 0, noise: int = -1,
+               tta_mode: int = 0, batch: int = 4, num_streams: int = 2,
+               tile_pad: Optional[int] = None, precision: str = "fp16",
+               calib_cache: str = "", use_cuda_graph: bool = False) -> vs.VideoNode:
+    """
+    Real-CUGAN upscaling function for VapourSynth
+
+    Args:
+        clip: Input video clip
+        model_path: Path to Real-CUGAN model
+        scale: Upscaling factor (2 or 4)
+        tile: Tile size for processing
+        device_id: GPU device ID
+        noise: Noise reduction level (-1, 0, 1, 2, 3)
+        tta_mode: Test-time augmentation
+        batch: Number of consecutive frames upscaled per inference call
+        num_streams: Number of worker processes kept busy in parallel
+        tile_pad: Overlap around each tile in pixels (default 10% of tile)
+        precision: Inference precision (fp32, fp16 or int8; int8 needs TensorRT)
+        calib_cache: TensorRT INT8 calibration cache path
+        use_cuda_graph: Replay inference as a CUDA graph
+    """
+
+    if not model_path:
+        # Use default model based on scale
+        if scale == 2:
+            model_path = "/models/realcugan/Real-CUGAN_up2x-latest-denoise3x.pth"
+        else:
+            model_path = "/models/realcugan/Real-CUGAN_up4x-latest-conservative.pth"
 
-        return upscaler(clip)
+    upscaler = _get_upscaler(model_path, scale, tile, device_id, tta_mode, batch, num_streams,
+                             tile_pad, precision, calib_cache, use_cuda_graph)
 
-    return real_cugan
+    return upscaler(clip)
 
 
 # Register function with VapourSynth
@@ -269,7 +836,7 @@ if __name__ == "__main__":
 else:
     # Register the function when imported
     try:
-        core.realcugan = create_real_cugan_function()
-        print("[Real-CUGAN] VapourSynth wrapper registered successfully")
+        core.realcugan = real_cugan
+        logger.info("VapourSynth wrapper registered successfully")
     except Exception as e:
-        print(f"[Real-CUGAN] Failed to register VapourSynth wrapper: {e}")
\ No newline at end of file
+        logger.warning("Failed to register VapourSynth wrapper: %s", e)